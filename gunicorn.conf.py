@@ -6,15 +6,30 @@ bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
 backlog = 2048
 
 # Worker processes
-workers = 1
-worker_class = "sync"
+# gthread workers keep /health responsive while other threads sit in ONNX
+# inference (onnxruntime releases the GIL during session.run)
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, os.cpu_count() or 1)))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
 worker_connections = 1000
 timeout = 120
 keepalive = 30
-max_requests = 100
-max_requests_jitter = 50
+# Recycle rarely: every restart re-pays the rembg/onnxruntime import cost
+max_requests = 10000
+max_requests_jitter = 500
+# Load the app (and its rembg model) once in the master and fork it into workers
 preload_app = True
 
+def when_ready(server):
+    # Load and warm up the model before any worker is forked
+    import main
+    main.get_session()
+
+def worker_exit(server, worker):
+    # Stop the worker's inference pool (INFERENCE_PROCESSES) so exits do not hang on it
+    import main
+    main.shutdown_inference_executor()
+
 # Logging
 loglevel = "info"
 accesslogformat = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
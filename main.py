@@ -4,31 +4,548 @@ Background Removal API - Render Deployment Version
 A Flask-based API for removing backgrounds from images using the rembg library.
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, after_this_request, request, jsonify, send_file
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+import orjson
 import os
+import sys
+import atexit
+import shutil
+import queue
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
 import uuid
 import tempfile
 from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser, ParseFailedException
+from streaming_form_data.targets import ValueTarget
 from rembg import remove
-from PIL import Image
+from rembg.sessions import sessions_class
+from rembg.sessions.u2net import U2netSession
+import onnxruntime as ort
+from PIL import Image, ImageOps, ExifTags, features
 import io
+import hashlib
 import logging
+import cachetools
+from functools import lru_cache
+from contextlib import redirect_stdout
+import numpy as np
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson, keeping Flask's sorted-key output"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        return self._app.response_class(body, mimetype='application/json')
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Configuration for Render
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Compress JSON responses; PNG/WebP results are not in COMPRESS_MIMETYPES and pass through untouched
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 256
+Compress(app)
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+# JPEG decoding is a large share of non-inference request time; Pillow's wheels
+# bundle the SIMD libjpeg-turbo, make it visible if a build lacks it
+if features.check_feature('libjpeg_turbo'):
+    logger.info(f"Pillow JPEG codec: libjpeg-turbo {features.version_feature('libjpeg_turbo')}")
+else:
+    logger.warning("Pillow is not linked against libjpeg-turbo, JPEG decoding will be slower")
+
+# Same for the ONNX Runtime and NumPy builds doing the inference math
+logger.info(f"ONNX Runtime {ort.__version__} ({ort.get_device()}), available providers: {ort.get_available_providers()}")
+numpy_config = io.StringIO()
+with redirect_stdout(numpy_config):
+    np.show_config()
+logger.info(f"NumPy {np.__version__} build configuration:\n{numpy_config.getvalue().rstrip()}")
+
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'webp'})
+
+# Hosting platform reported by / and /health
+PLATFORM = os.environ.get('PLATFORM', 'Render')
+
+# Computed once, /health is hit every few seconds by Render's health checks
+START_UUID = uuid.uuid4().hex
+PY_VERSION = f"Python {sys.version.split()[0]}"
+
+# Model configuration
+REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2netp')
+# INT8 dynamic quantization is opt-in: it shrinks the model ~4x, but mask
+# quality and speed depend on the CPU, so benchmark before enabling it
+QUANTIZE_MODEL = os.environ.get('REMBG_QUANTIZE', '0') == '1'
+# One intra-op thread per session: gunicorn already runs a worker per core,
+# larger ONNX Runtime thread pools would just oversubscribe the CPU
+ORT_INTRA_THREADS = int(os.environ.get('ORT_INTRA_THREADS', '1'))
+# U2-Net predicts at 320x320, so larger inputs are downscaled to this longest
+# side before inference and only the resulting mask is scaled back up
+MAX_INFERENCE_DIM = int(os.environ.get('MAX_DIM', '1024'))
+# Used automatically when onnxruntime-openvino is installed instead of onnxruntime
+# (ONNXRUNTIME_PACKAGE in render.yaml). Device and precision are separate options
+# since the OpenVINO provider deprecated combined values like CPU_FP32
+OPENVINO_DEVICE_TYPE = os.environ.get('OPENVINO_DEVICE_TYPE', 'CPU')
+OPENVINO_PRECISION = os.environ.get('OPENVINO_PRECISION', 'FP32')
+# Optional pool of dedicated inference processes per gunicorn worker. Off by
+# default: gthread workers already overlap inference across threads, since
+# onnxruntime releases the GIL while the model runs. Pool processes are spawned,
+# not forked from the multithreaded worker, so each loads its own copy of the model
+INFERENCE_PROCESSES = int(os.environ.get('INFERENCE_PROCESSES', '0'))
+# Opt-in micro-batching: concurrent requests within MAX_BATCH_WAIT_MS of each
+# other share one session.run call of up to MAX_BATCH_SIZE images. Batches run
+# one at a time on a single thread per worker, so the worker's threads no longer
+# overlap inference; raise ORT_INTRA_THREADS with it (1 disables batching)
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '1'))
+MAX_BATCH_WAIT_MS = float(os.environ.get('MAX_BATCH_WAIT_MS', '20'))
+
+# Output encoders: zlib level 1 encodes RGBA PNGs several times faster than the
+# default level 6 for slightly larger files, lossless WebP is smaller still
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_LEVEL', '1'))
+# Largest width or height lossless WebP can encode, bigger results fall back to PNG
+WEBP_MAX_DIM = 16383
+OUTPUT_FORMATS = {
+    'png': {
+        'format': 'PNG',
+        'mimetype': 'image/png',
+        'options': {'compress_level': PNG_COMPRESS_LEVEL, 'optimize': False}
+    },
+    'webp': {
+        'format': 'WEBP',
+        'mimetype': 'image/webp',
+        'options': {'lossless': True, 'quality': 90, 'method': 4}
+    }
+}
+
+def session_options():
+    """ONNX Runtime session options shared by every model we load"""
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opts.intra_op_num_threads = ORT_INTRA_THREADS
+    opts.inter_op_num_threads = 1
+    return opts
+
+def execution_providers():
+    """Prefer the OpenVINO execution provider when it is available"""
+    if 'OpenVINOExecutionProvider' in ort.get_available_providers():
+        return [
+            ('OpenVINOExecutionProvider', {'device_type': OPENVINO_DEVICE_TYPE, 'precision': OPENVINO_PRECISION}),
+            'CPUExecutionProvider'
+        ]
+    return ['CPUExecutionProvider']
+
+def quantized_model_path(model_path):
+    """Return the path of an INT8 copy of the model, or the model itself if quantizing fails"""
+    root, ext = os.path.splitext(model_path)
+    quantized_path = f"{root}.uint8{ext}"
+    if os.path.exists(quantized_path):
+        return quantized_path
+
+    logger.info(f"Quantizing {model_path} to INT8")
+    tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+    try:
+        # onnxruntime.quantization pulls in the onnx package, only import it when needed
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        # Signed weights turn convolutions into ConvInteger nodes the CPU provider
+        # cannot run, it only implements ConvInteger for uint8
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QUInt8)
+        # Only keep a model ONNX Runtime can actually load
+        ort.InferenceSession(tmp_path, providers=['CPUExecutionProvider'])
+    except Exception as e:
+        logger.warning(f"INT8 quantization failed, using the FP32 model: {e}")
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        return model_path
+
+    os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+def optimized_model_path(model_path):
+    """Return the path of a graph-optimized copy of the model, saving it on first use"""
+    root, ext = os.path.splitext(model_path)
+    # Keyed on the ORT version, since a saved graph is only valid for the runtime that wrote it
+    optimized_path = f"{root}.ort{ort.__version__}.opt{ext}"
+    if not os.path.exists(optimized_path):
+        logger.info(f"Saving graph-optimized copy of {model_path}")
+        # Only the portable EXTENDED fusions are saved, ENABLE_ALL adds layout
+        # changes specific to this CPU that are redone at every session load
+        opts = session_options()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+        opts.optimized_model_filepath = tmp_path
+        ort.InferenceSession(model_path, sess_options=opts, providers=['CPUExecutionProvider'])
+        os.replace(tmp_path, optimized_path)
+    return optimized_path
+
+@lru_cache(maxsize=None)
+def normalization_constants(mean, std):
+    """Per-channel (1 / std, mean / std) shaped to broadcast over CHW arrays"""
+    std = np.array(std, dtype=np.float32).reshape(3, 1, 1)
+    mean = np.array(mean, dtype=np.float32).reshape(3, 1, 1)
+    return 1.0 / std, mean / std
+
+class BatchScheduler:
+    """Stand-in for an InferenceSession that merges concurrent run() calls into batches"""
+
+    def __init__(self, session, max_batch, max_wait):
+        self.session = session
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.input_name = session.get_inputs()[0].name
+        self._reset()
+        # Threads do not survive a fork (gunicorn workers, the inference pool), and a
+        # queue the parent's batching thread was waiting on would never wake the child's
+        os.register_at_fork(after_in_child=self._reset)
+
+    def __getattr__(self, name):
+        # get_inputs(), get_outputs() and friends go straight to the real session
+        return getattr(self.session, name)
+
+    def _reset(self):
+        self.q = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_started = False
+
+    def _ensure_worker(self):
+        with self._lock:
+            if not self._worker_started:
+                threading.Thread(target=self._run_batches, daemon=True).start()
+                self._worker_started = True
+
+    def run(self, output_names, input_feed, run_options=None):
+        if output_names is not None or run_options is not None or list(input_feed) != [self.input_name]:
+            return self.session.run(output_names, input_feed, run_options)
+
+        self._ensure_worker()
+        future = Future()
+        self.q.put((input_feed[self.input_name], future))
+        return future.result()
+
+    def _run_batches(self):
+        while True:
+            items = [self.q.get()]
+            try:
+                self._collect_and_run(items)
+            except Exception as e:
+                # Keep the thread alive: callers wait on their futures without a timeout
+                logger.error(f"Batched inference failed: {e}")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _collect_and_run(self, items):
+        """Top up items with requests arriving within max_wait and run them"""
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self.q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Only tensors of the same shape can be stacked
+        groups = {}
+        for item in items:
+            groups.setdefault(item[0].shape[1:], []).append(item)
+        for group in groups.values():
+            self._run_batch(group)
+
+    def _run_batch(self, items):
+        try:
+            batch = np.concatenate([tensor for tensor, _ in items], axis=0)
+            outputs = self.session.run(None, {self.input_name: batch})
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for tensor, future in items:
+            size = tensor.shape[0]
+            future.set_result([output[offset:offset + size] for output in outputs])
+            offset += size
+
+class TunedSession:
+    """Mixin for rembg session classes that builds the ONNX session itself"""
+
+    def __init__(self, model_name, sess_opts, providers=None, *args, **kwargs):
+        self.model_name = model_name
+        self.providers = providers or ['CPUExecutionProvider']
+
+        model_path = str(self.__class__.download_models(*args, **kwargs))
+        if QUANTIZE_MODEL:
+            model_path = quantized_model_path(model_path)
+
+        provider_names = [p[0] if isinstance(p, tuple) else p for p in self.providers]
+        if 'OpenVINOExecutionProvider' in provider_names:
+            # OpenVINO compiles and optimizes the graph itself, ORT's CPU fusions only get in its way
+            sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            # Start from the saved fusions, only the cheap hardware-specific passes run here
+            model_path = optimized_model_path(model_path)
+
+        self.inner_session = ort.InferenceSession(
+            model_path,
+            sess_options=sess_opts,
+            providers=self.providers
+        )
+
+        # Run one dummy inference at boot so ONNX Runtime's first-run setup (kernel
+        # selection, arena allocation) happens before gunicorn forks the workers.
+        # It goes to the raw session, so the master forks without a batching thread
+        logger.info(f"Warming up {model_name}...")
+        self.predict(Image.new('RGB', (320, 320), (128, 128, 128)))
+
+        if MAX_BATCH_SIZE > 1:
+            if isinstance(self.inner_session.get_inputs()[0].shape[0], int):
+                logger.info(f"{model_name} has a fixed batch size, not batching requests")
+            else:
+                self.inner_session = BatchScheduler(self.inner_session, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS / 1000)
+
+    def normalize(self, img, mean, std, size, *args, **kwargs):
+        """Build the model input in one float32 pass instead of rembg's float64 temporaries"""
+        pixels = np.asarray(img.convert('RGB').resize(size, Image.Resampling.LANCZOS))
+        inv_std, bias = normalization_constants(tuple(mean), tuple(std))
+
+        # Like rembg, scale by the brightest value in the image rather than by 255
+        peak = float(pixels.max()) or 1.0
+        tensor = np.empty((1, 3, pixels.shape[0], pixels.shape[1]), dtype=np.float32)
+        np.multiply(pixels.transpose(2, 0, 1), inv_std / peak, out=tensor[0])
+        tensor -= bias
+
+        return {self.inner_session.get_inputs()[0].name: tensor}
+
+def load_session(model_name):
+    """Create a rembg session for model_name backed by our own ONNX session"""
+    base_class = next((sc for sc in sessions_class if sc.name() == model_name), U2netSession)
+    session_class = type(base_class.__name__, (TunedSession, base_class), {})
+    return session_class(model_name, session_options(), execution_providers())
+
+# The model is loaded once per process by get_session(). gunicorn.conf.py calls it
+# at boot in the master, so every forked worker reuses the same ONNX session
+SESSION = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Return this process's rembg session, loading the model on first use"""
+    global SESSION
+    with _session_lock:
+        if SESSION is None:
+            logger.info(f"Loading rembg model: {REMBG_MODEL} (quantized: {QUANTIZE_MODEL})")
+            SESSION = load_session(REMBG_MODEL)
+            logger.info(f"ONNX Runtime providers: {SESSION.inner_session.get_providers()}")
+        return SESSION
+
+def predict_mask(image):
+    """Run the rembg model on an image and return its alpha mask"""
+    return remove(image, session=get_session(), only_mask=True)
+
+def init_inference_process():
+    """Initializer for spawned pool processes, which load their own copy of the model"""
+    # Shutdown is driven by the gunicorn worker that owns the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    get_session()
+
+_inference_executor = None
+_inference_executor_lock = threading.Lock()
+
+def inference_executor():
+    """Return this worker's inference pool, creating it on first use"""
+    global _inference_executor
+    with _inference_executor_lock:
+        if _inference_executor is None:
+            # Started lazily so the pool belongs to the gunicorn worker, not the preloading master.
+            # Forking a worker that has other threads and a live ONNX Runtime can deadlock the
+            # children and hang interpreter shutdown, so pool processes start from scratch
+            _inference_executor = ProcessPoolExecutor(
+                max_workers=INFERENCE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_inference_process
+            )
+        return _inference_executor
+
+def shutdown_inference_executor():
+    """Stop this worker's inference pool, if it started one"""
+    global _inference_executor
+    with _inference_executor_lock:
+        if _inference_executor is not None:
+            _inference_executor.shutdown(wait=True, cancel_futures=True)
+            _inference_executor = None
+
+def replace_inference_executor(broken):
+    """Swap out a pool that lost a process, unless another thread already did"""
+    global _inference_executor
+    with _inference_executor_lock:
+        if _inference_executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _inference_executor = None
+
+def run_inference(image):
+    """Predict the alpha mask of an image, in the inference pool if one is configured"""
+    if INFERENCE_PROCESSES > 0:
+        executor = inference_executor()
+        try:
+            return executor.submit(predict_mask, image).result()
+        except BrokenProcessPool:
+            # A pool process died (e.g. OOM-killed), which breaks the whole pool for good
+            logger.warning("Inference pool is broken, starting a new one")
+            replace_inference_executor(executor)
+            return inference_executor().submit(predict_mask, image).result()
+    return predict_mask(image)
+
+def cut_out(image):
+    """Remove the background from an image, keeping its original resolution"""
+    # Apply EXIF rotation up front so the mask lines up with the pixels we return
+    if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA')
+
+    if max(image.size) > MAX_INFERENCE_DIM:
+        small = ImageOps.contain(image, (MAX_INFERENCE_DIM, MAX_INFERENCE_DIM), Image.Resampling.LANCZOS)
+        logger.info(f"Downscaled image to {small.size} for inference")
+        mask = run_inference(small).resize(image.size, Image.Resampling.BILINEAR)
+    else:
+        mask = run_inference(image)
+
+    # Same compositing as rembg's naive cutout: transparent pixels become (0, 0, 0, 0)
+    return Image.composite(image, Image.new('RGBA', image.size, 0), mask)
+
+# Encoded results are written to files so gunicorn can send them with
+# sendfile(2) instead of copying the bytes through Python. Each worker gets its
+# own directory, created on first use and removed when the worker exits
+_result_dir = None
+_result_dir_lock = threading.Lock()
+
+def remove_result_dir(path, pid):
+    """atexit handler deleting a result directory, only in the process that created it"""
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+def result_dir():
+    """Return this process's result directory, creating it on first use"""
+    global _result_dir
+    with _result_dir_lock:
+        if _result_dir is None or _result_dir[0] != os.getpid():
+            path = tempfile.mkdtemp(prefix='rembg-results-')
+            atexit.register(remove_result_dir, path, os.getpid())
+            _result_dir = (os.getpid(), path)
+        return _result_dir[1]
+
+class ResultCache(cachetools.LRUCache):
+    """LRU of encoded result files that deletes each file when it is evicted"""
+
+    def popitem(self):
+        key, path = super().popitem()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return key, path
+
+# Recent results keyed by upload hash and output format, so retried or
+# duplicate uploads skip inference entirely. Bounded by the bytes each worker
+# keeps in its result directory, full-resolution PNGs can exceed 100MB each
+CACHE_BYTES = int(os.environ.get('CACHE_BYTES', str(64 * 1024 * 1024)))
+RESULT_CACHE = ResultCache(maxsize=CACHE_BYTES, getsizeof=os.path.getsize) if CACHE_BYTES > 0 else None
+RESULT_CACHE_LOCK = threading.Lock()
+
+def send_cached_result(key, **kwargs):
+    """Return a send_file response for the result cached under key, or None"""
+    if RESULT_CACHE is None:
+        return None
+    with RESULT_CACHE_LOCK:
+        path = RESULT_CACHE.get(key)
+        # send_file opens the file right away, so eviction cannot delete it mid-response
+        return send_file(path, **kwargs) if path else None
+
+def cache_result(key, path):
+    """Store a result file under key, returning False if it was not kept"""
+    if RESULT_CACHE is None:
+        return False
+    with RESULT_CACHE_LOCK:
+        if key in RESULT_CACHE:
+            # A concurrent request for the same upload got there first
+            return False
+        try:
+            RESULT_CACHE[key] = path
+        except ValueError:
+            # Larger than the whole cache
+            return False
+        return True
+
+def save_result(image, output_format, extension):
+    """Encode an image into a new file in the result directory and return its path"""
+    fd, path = tempfile.mkstemp(suffix=f'.{extension}', dir=result_dir())
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, output_format['format'], **output_format['options'])
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+class CountingValueTarget(ValueTarget):
+    """ValueTarget that also counts how many parts were sent under its field name"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parts = 0
+
+    def on_start(self):
+        super().on_start()
+        self.parts += 1
+
+def read_uploaded_image(chunk_size=64 * 1024):
+    """Parse the multipart body, returning the filename, bytes and part count of the image field"""
+    # streaming-form-data's C parser is much cheaper than werkzeug's form parsing
+    parser = StreamingFormDataParser(headers=request.headers)
+    # A repeated field is fed into the same target, concatenating the files
+    target = CountingValueTarget()
+    parser.register('image', target)
+    while chunk := request.stream.read(chunk_size):
+        parser.data_received(chunk)
+    return target.multipart_filename, target.value, target.parts
+
+def negotiate_output_format(size):
+    """Return WebP if the client explicitly accepts it and the image fits, PNG otherwise"""
+    if max(size) > WEBP_MAX_DIM:
+        return 'png'
+    # Only an explicit image/webp entry counts, not */*, and q=0 means "not acceptable"
+    if any(mimetype == 'image/webp' and quality > 0 for mimetype, quality in request.accept_mimetypes):
+        return 'webp'
+    return 'png'
 
 def allowed_file(filename):
     """Check if the file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
 
 @app.route('/', methods=['GET'])
 def home():
@@ -37,7 +554,7 @@ def home():
         "message": "Background Removal API",
         "version": "1.0.0",
         "status": "running",
-        "platform": "Render",
+        "platform": PLATFORM,
         "endpoints": {
             "health": "GET /health",
             "remove_background": "POST /remove-background",
@@ -61,9 +578,9 @@ def health_check():
     """Health check endpoint to verify API is running"""
     return jsonify({
         "status": "healthy", 
-        "message": "Background Removal API is running on Render",
-        "timestamp": str(uuid.uuid4()),
-        "python_version": f"Python {os.sys.version.split()[0]}"
+        "message": f"Background Removal API is running on {PLATFORM}",
+        "timestamp": f"{START_UUID}-{time.time_ns()}",
+        "python_version": PY_VERSION
     }), 200
 
 @app.route('/remove-background', methods=['POST'])
@@ -75,56 +592,81 @@ def remove_background():
     """
     logger.info("Received background removal request")
     
-    if 'image' not in request.files:
+    try:
+        filename, image_bytes, image_parts = read_uploaded_image()
+    except ParseFailedException as e:
+        logger.warning(f"Could not parse upload: {str(e)}")
+        filename = None
+    
+    if filename is None:
         logger.warning("No image file provided in request")
         return jsonify({"error": "No image file provided", "field": "image"}), 400
     
-    file = request.files['image']
+    if image_parts > 1:
+        logger.warning(f"{image_parts} image files provided in one request")
+        return jsonify({"error": "Only one image file per request", "field": "image"}), 400
     
-    if file.filename == '':
+    if filename == '':
         logger.warning("Empty filename provided")
         return jsonify({"error": "No image selected"}), 400
     
-    if not allowed_file(file.filename):
-        logger.warning(f"Unsupported file type: {file.filename}")
+    if not allowed_file(filename):
+        logger.warning(f"Unsupported file type: {filename}")
         return jsonify({
             "error": f"File type not allowed. Supported types: {', '.join(ALLOWED_EXTENSIONS)}",
-            "filename": file.filename
+            "filename": filename
         }), 400
     
     try:
-        logger.info(f"Processing image: {file.filename}")
+        logger.info(f"Processing image: {filename}")
         
-        # Read image directly from memory (no disk storage needed)
-        input_image = Image.open(file.stream)
+        # Read image directly from memory (no disk storage needed); only the
+        # header is parsed here, pixels are decoded when the image is first used
+        input_image = Image.open(io.BytesIO(image_bytes))
         
         # Log image info
         logger.info(f"Image size: {input_image.size}, format: {input_image.format}, mode: {input_image.mode}")
         
+        extension = negotiate_output_format(input_image.size)
+        output_format = OUTPUT_FORMATS[extension]
+        
+        # Generate filename for download
+        base_name = os.path.splitext(secure_filename(filename))[0]
+        download_filename = f"{base_name}_no_background.{extension}"
+        send_options = {
+            'mimetype': output_format['mimetype'],
+            'as_attachment': True,
+            'download_name': download_filename
+        }
+        
+        cache_key = (hashlib.blake2b(image_bytes, digest_size=16).digest(), extension)
+        cached_response = send_cached_result(cache_key, **send_options)
+        if cached_response is not None:
+            logger.info(f"Sending cached result: {download_filename}")
+            # The format depends on Accept, shared caches must not mix them up
+            cached_response.vary.add('Accept')
+            return cached_response
+        
         # Process the image with rembg (this may take 10-60 seconds)
         logger.info("Starting background removal process...")
-        output_image = remove(input_image)
+        output_image = cut_out(input_image)
         logger.info("Background removal completed")
         
-        # Convert to bytes for response
-        img_io = io.BytesIO()
-        output_image.save(img_io, 'PNG')
-        img_io.seek(0)
-        
-        # Generate filename for download
-        original_name = secure_filename(file.filename)
-        base_name = os.path.splitext(original_name)[0]
-        download_filename = f"{base_name}_no_background.png"
+        result_path = save_result(output_image, output_format, extension)
         
         logger.info(f"Sending processed image: {download_filename}")
         
-        # Return the processed image
-        return send_file(
-            img_io, 
-            mimetype='image/png',
-            as_attachment=True,
-            download_name=download_filename
-        )
+        # Return the processed image; a file path lets gunicorn use sendfile(2)
+        response = send_file(result_path, **send_options)
+        response.vary.add('Accept')
+        if not cache_result(cache_key, result_path):
+            @after_this_request
+            def remove_result_file(response):
+                # send_file already holds the file open, unlinking only drops the name
+                os.unlink(result_path)
+                return response
+        
+        return response
     
     except Exception as e:
         error_msg = str(e)
@@ -132,7 +674,7 @@ def remove_background():
         return jsonify({
             "error": "Failed to process image", 
             "details": error_msg,
-            "filename": file.filename if file else "unknown"
+            "filename": filename
         }), 500
 
 @app.errorhandler(413)
@@ -157,5 +699,6 @@ def internal_error(e):
     return jsonify({"error": "Internal server error"}), 500
 
 if __name__ == '__main__':
+    get_session()
     port = int(os.environ.get('PORT', 10000))  # Render uses port 10000 by default
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file